@@ -16,7 +16,8 @@ def validate_datasets(datasets, datasets_directory="datasets"):
 
 
 def get_data(dataset, datasets_directory="datasets", convert_numbers=True):
-    truths_mapping = pickle.load(open("%s/%s/ground_truths.p" % (datasets_directory, dataset), 'rb'))
+    with open("%s/%s/ground_truths.p" % (datasets_directory, dataset), 'rb') as truths_file:
+        truths_mapping = pickle.load(truths_file)
     truths = truths_mapping.values()
     if convert_numbers and not all(isinstance(truth, Number) for truth in truths):
         try:
@@ -2,24 +2,82 @@ import argparse
 import glob
 import os
 import pickle
+import pickletools
+import shlex
 import shutil
+import subprocess
 import tarfile
-import xml.etree.ElementTree as xml
-from urllib.request import urlretrieve
+from concurrent import futures
+
+try:
+    from lxml import etree
+except ImportError:  # plain ElementTree parses the same, just slower
+    import xml.etree.ElementTree as etree
 
 import functools
+import requests
 
 from net import vgg16, vgg19, resnet50, inceptionv3
 
 
+def __pickle_load(filepath):
+    with open(filepath, 'rb') as file:
+        return pickle.load(file)
+
+
+def __pickle_dump(obj, filepath):
+    # the highest protocol serializes through the C fast paths;
+    # optimize drops unused memo put opcodes, shrinking the file
+    with open(filepath, 'wb') as file:
+        file.write(pickletools.optimize(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)))
+
+
 def __retrieve_tarred_content(remote_url, local_path):
+    tar_path = __retrieve_tar(remote_url, local_path)
+    if tar_path is not None:
+        __extract_tar(tar_path, local_path)
+
+
+def __retrieve_tar(remote_url, local_path):
+    """
+    Retrieve the tar behind `remote_url` if `local_path` does not exist yet.
+    Unless a previously downloaded tar is already on disk, the content is
+    extracted directly from the HTTP stream and nothing needs extracting afterwards.
+    Returns the path of the downloaded tar, or None if nothing needs extracting.
+    """
     assert remote_url.endswith(".tar.gz") or remote_url.endswith(".tar")
     if os.path.exists(local_path):
         print("Not downloading %s - local path %s already exists" % (remote_url, local_path))
-        return
+        return None
     tar_path = "%s.%s" % (local_path, "tar.gz" if remote_url.endswith(".tar.gz") else "tar")
-    __download_if_needed(tar_path, functools.partial(__download_from_url, url=remote_url))
-    __extract_tar(tar_path, local_path)
+    if os.path.isfile(tar_path):  # resume the download -> extract two-step path
+        print("Not downloading %s (exists already)" % tar_path)
+        return tar_path
+    __stream_extract_tar(remote_url, local_path)
+    return None
+
+
+def __stream_extract_tar(url, target_directory):
+    """
+    Extract a tar directly from the HTTP stream, without the intermediate
+    tarball on disk - this halves the disk I/O and overlaps network with extraction.
+    Extraction goes into a staging directory that is only renamed to
+    `target_directory` once the stream completed, so an interrupted transfer
+    cannot leave a partial tree that a rerun would mistake for complete.
+    """
+    print("Streaming %s to %s..." % (url, target_directory))
+    staging_directory = "%s.extracting" % target_directory
+    if os.path.isdir(staging_directory):  # leftover from an interrupted run
+        shutil.rmtree(staging_directory)
+    try:
+        with requests.get(url, stream=True) as response:
+            response.raise_for_status()
+            with tarfile.open(fileobj=response.raw, mode="r|gz" if url.endswith(".tar.gz") else "r|") as tar:
+                __extract_members(tar, staging_directory)
+        os.rename(staging_directory, target_directory)
+    except BaseException:
+        shutil.rmtree(staging_directory, ignore_errors=True)
+        raise
 
 
 def __download_if_needed(local_path, retrieve):
@@ -32,16 +90,75 @@ def __download_if_needed(local_path, retrieve):
     return download_needed
 
 
-def __download_from_url(url, local_path):
+class __RangeNotHonored(Exception):
+    """Raised when a server answers a ranged GET with the full body instead of 206 Partial Content."""
+
+
+def __download_from_url(url, local_path, num_connections=8):
     filepart_path = "%s.filepart" % local_path
-    urlretrieve(url, filepart_path)
+    head = requests.head(url, allow_redirects=True)
+    content_length = int(head.headers.get('Content-Length', 0))
+    if content_length > 0 and head.headers.get('Accept-Ranges') == 'bytes':
+        try:
+            __download_ranges(url, filepart_path, content_length, num_connections)
+        except __RangeNotHonored:  # some servers advertise Accept-Ranges but ignore the Range header
+            __download_stream(url, filepart_path)
+    else:  # server does not support range requests - fall back to a single stream
+        __download_stream(url, filepart_path)
     shutil.move(filepart_path, local_path)
 
 
+def __download_stream(url, filepart_path):
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(filepart_path, 'wb') as file:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                file.write(chunk)
+
+
+def __download_ranges(url, filepart_path, content_length, num_connections):
+    """
+    Download `url` over several parallel HTTP range requests, each writing its
+    byte range directly into the preallocated `filepart_path`.
+    A single TCP stream rarely saturates the available bandwidth for large files.
+    """
+    range_size = -(-content_length // num_connections)  # ceiling division
+    with open(filepart_path, 'wb') as file:
+        file.truncate(content_length)
+    fd = os.open(filepart_path, os.O_WRONLY)
+    try:
+        with futures.ThreadPoolExecutor(max_workers=num_connections) as executor:
+            downloads = [executor.submit(__download_range, url, fd, start,
+                                         min(start + range_size, content_length) - 1)
+                         for start in range(0, content_length, range_size)]
+            for download in downloads:
+                download.result()
+    finally:
+        os.close(fd)
+
+
+def __download_range(url, fd, start, end):
+    with requests.get(url, headers={'Range': 'bytes=%d-%d' % (start, end)}, stream=True) as response:
+        response.raise_for_status()
+        if response.status_code != requests.codes.partial_content:
+            # the server sent the full body - writing it at this range's offset would corrupt the file
+            raise __RangeNotHonored("%s answered the ranged GET with status %d" % (url, response.status_code))
+        offset = start
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+
+
+@functools.lru_cache(maxsize=1)
+def __list_keras_models():
+    # listing ~/.keras/models can be slow e.g. over NFS - cache it across the models
+    return os.listdir(os.path.expanduser("~/.keras/models"))
+
+
 def __find_keras_weights(weights_prefix):
     weights_directory = os.path.expanduser("~/.keras/models")
-    weights_files = [f for f in os.listdir(weights_directory) if f.startswith(weights_prefix)]
-    assert len(weights_files) is 1
+    weights_files = [f for f in __list_keras_models() if f.startswith(weights_prefix)]
+    assert len(weights_files) == 1
     return os.path.join(weights_directory, weights_files[0])
 
 
@@ -49,19 +166,67 @@ def __load_keras_model(model_builder, local_path):
     model = model_builder(weights='imagenet')
     weights_path = __find_keras_weights(model.name)
     shutil.move(weights_path, local_path)
+    __list_keras_models.cache_clear()  # the move changed the directory contents
 
 
 def __extract_tar(filepath, target_directory="."):
     print("Untarring %s to %s..." % (filepath, target_directory))
-    tar = tarfile.open(filepath, "r:gz" if filepath.endswith(".tar.gz") else "r:")
-    tar.extractall(target_directory)
-    tar.close()
+    if filepath.endswith(".tar.gz") and shutil.which("pigz"):
+        # pigz decompresses on all cores, where the stdlib gzip module is single-threaded
+        os.makedirs(target_directory, exist_ok=True)
+        # pipefail so that a pigz failure (e.g. a bad gzip CRC) fails the run
+        # even when tar exits 0 after having consumed all the member data
+        subprocess.run(["bash", "-c", "set -o pipefail; pigz -dc %s | tar -x -C %s"
+                        % (shlex.quote(filepath), shlex.quote(target_directory))], check=True)
+    else:
+        with tarfile.open(filepath, "r:gz" if filepath.endswith(".tar.gz") else "r:") as tar:
+            __extract_members(tar, target_directory)
     os.remove(filepath)
 
 
-def __download_dataset(dataset, data_urls, convert_truths, collect_image_files, datasets_directory="datasets"):
+def __extract_members(tar, target_directory, max_in_flight_bytes=128 * 1024 * 1024):
+    """
+    Extract all members of `tar`, reading the archive sequentially but handing
+    the open/write/close of small files to a thread pool - otherwise the many
+    small files of e.g. the ImageNet synset tars serialize on per-file
+    filesystem latency. Pending writes are capped by their total payload size
+    so that buffered members never pile up in memory; members too large for
+    the budget (e.g. the inner tars of the ImageNet train set) stream to disk
+    through tarfile's constant-size copy buffer instead of being buffered.
+    """
+    large_member_size = max_in_flight_bytes // 8
+    with futures.ThreadPoolExecutor(max_workers=8) as writers:
+        in_flight, in_flight_bytes = [], 0
+        for member in tar:
+            if not member.isfile() or member.size > large_member_size:
+                tar.extract(member, target_directory)
+                continue
+            while in_flight_bytes + member.size > max_in_flight_bytes:
+                done, pending = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+                for write in done:
+                    in_flight_bytes -= write.result()
+                in_flight = list(pending)
+            contents = tar.extractfile(member).read()
+            in_flight.append(writers.submit(__write_file, os.path.join(target_directory, member.name), contents))
+            in_flight_bytes += member.size
+        for write in in_flight:
+            write.result()
+
+
+def __write_file(filepath, contents):
+    directory = os.path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(filepath, 'wb') as file:
+        file.write(contents)
+    return len(contents)
+
+
+def __download_dataset(dataset, data_urls, convert_truths, collect_image_files, datasets_directory="datasets",
+                       executor=None):
     dataset_directory = os.path.join(datasets_directory, dataset)
     os.makedirs(dataset_directory, exist_ok=True)
+    pending_data_types = {}
     for data_type, data_url in data_urls.items():
         datatype_directory = os.path.join(dataset_directory, data_type)
         truths_filepath = os.path.join(datatype_directory, "ground_truths.p")
@@ -69,9 +234,27 @@ def __download_dataset(dataset, data_urls, convert_truths, collect_image_files,
         if os.path.isfile(truths_filepath) and os.path.isdir(images_directory):
             print("Skipping %s/%s - truths file and images directory exist" % (dataset, data_type))
             continue
+        pending_data_types[data_type] = data_url
+    # downloads are network-bound and independent - run them in parallel,
+    # then extract and convert only once everything has arrived
+    compressed_directories = {data_type: os.path.join(datasets_directory, dataset, data_type + "_compressed")
+                              for data_type in pending_data_types}
+    if executor is not None:
+        downloads = {data_type: executor.submit(__retrieve_tar, data_url, compressed_directories[data_type])
+                     for data_type, data_url in pending_data_types.items()}
+        futures.wait(list(downloads.values()))
+        tar_paths = {data_type: download.result() for data_type, download in downloads.items()}
+    else:
+        tar_paths = {data_type: __retrieve_tar(data_url, compressed_directories[data_type])
+                     for data_type, data_url in pending_data_types.items()}
+    for data_type in pending_data_types:
+        datatype_directory = os.path.join(dataset_directory, data_type)
+        truths_filepath = os.path.join(datatype_directory, "ground_truths.p")
+        images_directory = os.path.join(datatype_directory, "images")
         print("Retrieving %s/%s..." % (dataset, data_type))
-        compressed_directory = os.path.join(datasets_directory, dataset, data_type + "_compressed")
-        __retrieve_tarred_content(data_url, compressed_directory)
+        compressed_directory = compressed_directories[data_type]
+        if tar_paths[data_type] is not None:
+            __extract_tar(tar_paths[data_type], compressed_directory)
 
         # truths
         if os.path.isfile(truths_filepath):
@@ -81,7 +264,7 @@ def __download_dataset(dataset, data_urls, convert_truths, collect_image_files,
             truths = convert_truths(compressed_directory, data_type)
             assert truths, "No truths converted"
             os.makedirs(datatype_directory, exist_ok=True)
-            pickle.dump(truths, open(truths_filepath, 'wb'))
+            __pickle_dump(truths, truths_filepath)
 
         # images
         if os.path.isdir(images_directory):
@@ -92,31 +275,61 @@ def __download_dataset(dataset, data_urls, convert_truths, collect_image_files,
             assert image_files, "No images found"
             assert len(image_files) == len(truths), \
                 "Number of images (%d) differs from truths (%d)" % (len(image_files), len(truths))
-            images_truths_diffs = set(image_files) - set(truths.keys())
-            truths_images_diffs = set(truths.keys()) - set(image_files)
-            assert not images_truths_diffs and not truths_images_diffs, \
-                "image files and truths keys differ: only in images %s | only in truths %s" % (
-                    ', '.join(images_truths_diffs), ', '.join(truths_images_diffs))
-            os.makedirs(images_directory)
-            for image_file in image_files:
-                shutil.move(os.path.join(images_source_directory, image_file),
-                            os.path.join(images_directory, image_file))
-            shutil.rmtree(compressed_directory)
+            # with equal sizes, every image having a truth implies the keys match exactly -
+            # check via streaming dict lookups instead of materializing two full sets
+            image_without_truth = next((image_file for image_file in image_files if image_file not in truths), None)
+            assert image_without_truth is None, "image file %s has no truth" % image_without_truth
+            __move_images(images_source_directory, images_directory, image_files)
+            if os.path.isdir(compressed_directory):  # may itself have been renamed away
+                shutil.rmtree(compressed_directory)
+
+
+def __move_images(images_source_directory, images_directory, image_files):
+    """
+    Move the `image_files` from `images_source_directory` into `images_directory`.
+    If the source directory contains exactly the wanted images, a single rename
+    of the whole directory replaces the per-file moves.
+    """
+    os.makedirs(os.path.dirname(images_directory), exist_ok=True)
+    if len(os.listdir(images_source_directory)) == len(image_files):
+        # the image files were collected from the source directory,
+        # so equal counts mean it contains exactly the wanted images
+        os.rename(images_source_directory, images_directory)
+        return
+    os.makedirs(images_directory)
+    source_prefix = images_source_directory + os.sep
+    target_prefix = images_directory + os.sep
+    # os.rename within the same filesystem is a single syscall,
+    # without shutil.move's per-file stat and copy fallback
+    with futures.ThreadPoolExecutor(max_workers=32) as movers:
+        moves = [movers.submit(os.rename, source_prefix + image_file, target_prefix + image_file)
+                 for image_file in image_files]
+        for move in moves:
+            move.result()
 
 
 def __collect_images(images_directory, filetype):
     images_directory = os.path.realpath(images_directory)
-    image_files = glob.glob(os.path.join(images_directory, "*." + filetype))
-    return images_directory, [filepath[len(images_directory) + 1:] for filepath in image_files]
+    suffix = "." + filetype
+    # scandir iterates the directory without globbing full paths that would
+    # only be stripped back to names afterwards
+    with os.scandir(images_directory) as entries:
+        image_files = [entry.name for entry in entries if entry.name.endswith(suffix)]
+    return images_directory, image_files
 
 
-def __collect_imagenet2012_images(dataset_directory):
+def __collect_imagenet2012_images(dataset_directory, extract_workers=8):
     _, data_type = os.path.split(dataset_directory)
     if data_type.startswith("train"):
-        tarred_images = glob.glob(os.path.join(dataset_directory, "*.tar"))
+        with os.scandir(dataset_directory) as entries:
+            tarred_images = [entry.path for entry in entries if entry.name.endswith(".tar")]
         assert tarred_images, "No tarred images found"
-        for tar in tarred_images:
-            __extract_tar(tar, dataset_directory)
+        # each synset tar writes a disjoint set of files - extract them in parallel
+        with futures.ThreadPoolExecutor(max_workers=extract_workers) as executor:
+            extractions = [executor.submit(__extract_tar, tar, dataset_directory) for tar in tarred_images]
+            for num_extracted, extraction in enumerate(futures.as_completed(extractions), start=1):
+                extraction.result()
+                print("Extracted %d/%d tars" % (num_extracted, len(extractions)))
     return __collect_images(dataset_directory, "JPEG")
 
 
@@ -124,14 +337,35 @@ def __convert_voc_truths(dataset_directory):
     assert os.path.isdir(dataset_directory)
     xml_files = glob.glob("%s/*.xml" % dataset_directory)
     truths = {}
-    for file in xml_files:
-        contents = xml.parse(file)
-        filename = contents.find("filename").text
-        object_name = contents.find("./object/name").text
-        truths[filename] = object_name
+    # parsing is pure CPU with no shared state - spread the files across cores,
+    # with a chunksize large enough to amortize the pickling of the small per-file results
+    with futures.ProcessPoolExecutor() as executor:
+        for filename, object_name in executor.map(__parse_voc_annotation, xml_files, chunksize=64):
+            truths[filename] = object_name
     return truths
 
 
+def __parse_voc_annotation(xml_file):
+    """
+    Pull the filename and the first object name out of a VOC annotation xml.
+    Parses incrementally and stops once both fields are found,
+    instead of building the full annotation tree only to read two fields.
+    """
+    filename, object_name = None, None
+    for _, element in etree.iterparse(xml_file, events=('end',)):
+        if element.tag == 'filename':
+            filename = element.text
+            element.clear()
+        elif element.tag == 'object':
+            if object_name is None:
+                object_name = element.find('name').text
+            element.clear()
+        if filename is not None and object_name is not None:
+            break
+    assert filename is not None and object_name is not None, "Incomplete annotation in %s" % xml_file
+    return filename, object_name
+
+
 def __convert_imagenet2012_truths(dataset_directory, data_type):
     parent_directory, _ = os.path.split(dataset_directory)
     _, dataset = os.path.split(parent_directory)
@@ -141,9 +375,10 @@ def __convert_imagenet2012_truths(dataset_directory, data_type):
     __retrieve_tarred_content("http://dl.caffe.berkeleyvision.org/caffe_ilsvrc12.tar.gz", annotations_path)
     truths = {}
     with open(os.path.join(annotations_path, data_type + ".txt")) as annotations_file:
-        for line in annotations_file.readlines():
-            filename, truth = line.split(" ")
-            truths[filename] = truth
+        # iterate the file directly - readlines() would hold all 1.28M lines in memory at once
+        for line in annotations_file:
+            filename, _, truth = line.partition(" ")
+            truths[filename] = truth.rstrip("\n")
     return truths
 
 
@@ -154,34 +389,46 @@ if __name__ == '__main__':
                         help='The directory for the datasets')
     parser.add_argument('--weights_directory', type=str, default='weights',
                         help='The directory for the weights')
+    parser.add_argument('--extract_workers', type=int, default=min(8, os.cpu_count()),
+                        help='How many tars to extract in parallel - reduce this on spinning disks')
     args = parser.parse_args()
     print('Running with args', args)
 
-    # weights
-    __download_if_needed(os.path.join(args.weights_directory, "alexnet.h5"),
-                         functools.partial(__download_from_url,
-                                           url="http://files.heuritech.com/weights/alexnet_weights.h5"))
-    for model_builder in [vgg16, vgg19, resnet50, inceptionv3]:
-        __download_if_needed(os.path.join(args.weights_directory, model_builder.__name__ + ".h5"),
-                             functools.partial(__load_keras_model, model_builder=model_builder))
-
-    # datasets
-    imagenet_urls = pickle.load(open(os.path.join(args.datasets_directory, 'ILSVRC2012_image_urls.p'), 'rb'))
-    if not imagenet_urls:
-        print("Due to copyright constraints, ILSVRC2012 image urls must not be distributed. "
-              "Please pickle-dump a dictionary of the form {'train': <train_images_url.tar>, 'val': ..., 'test': ...} "
-              "to datasets/ILSVRC2012_image_urls.p")
-    else:
-        __download_dataset("ILSVRC2012", datasets_directory=args.datasets_directory,
-                           data_urls=imagenet_urls,
-                           convert_truths=__convert_imagenet2012_truths,
-                           collect_image_files=__collect_imagenet2012_images)
-
-    __download_dataset("VOC2012", datasets_directory=args.datasets_directory,
-                       data_urls={
-                           'train': 'http://host.robots.ox.ac.uk/pascal/VOC/voc2012/VOCtrainval_11-May-2012.tar',
-                           'val': 'http://host.robots.ox.ac.uk/pascal/VOC/voc2012/VOCtrainval_11-May-2012.tar'},
-                       convert_truths=lambda dataset_directory, _:
-                       __convert_voc_truths(os.path.join(dataset_directory, "VOCdevkit", "VOC2012", "Annotations")),
-                       collect_image_files=lambda dataset_directory:
-                       __collect_images(os.path.join(dataset_directory, "VOCdevkit", "VOC2012", "JPEGImages"), "jpg"))
+    with futures.ThreadPoolExecutor(max_workers=8) as executor:
+        # weights
+        weights_downloads = [
+            executor.submit(__download_if_needed, os.path.join(args.weights_directory, "alexnet.h5"),
+                            functools.partial(__download_from_url,
+                                              url="http://files.heuritech.com/weights/alexnet_weights.h5"))]
+        # keras model construction is not thread-safe and shares ~/.keras/models - keep it on the main thread
+        for model_builder in [vgg16, vgg19, resnet50, inceptionv3]:
+            __download_if_needed(os.path.join(args.weights_directory, model_builder.__name__ + ".h5"),
+                                 functools.partial(__load_keras_model, model_builder=model_builder))
+        for download in weights_downloads:  # re-raises download failures, which wait() would swallow
+            download.result()
+
+        # datasets
+        imagenet_urls = __pickle_load(os.path.join(args.datasets_directory, 'ILSVRC2012_image_urls.p'))
+        if not imagenet_urls:
+            print("Due to copyright constraints, ILSVRC2012 image urls must not be distributed. "
+                  "Please pickle-dump a dictionary of the form "
+                  "{'train': <train_images_url.tar>, 'val': ..., 'test': ...} "
+                  "to datasets/ILSVRC2012_image_urls.p")
+        else:
+            __download_dataset("ILSVRC2012", datasets_directory=args.datasets_directory,
+                               data_urls=imagenet_urls,
+                               convert_truths=__convert_imagenet2012_truths,
+                               collect_image_files=functools.partial(__collect_imagenet2012_images,
+                                                                     extract_workers=args.extract_workers),
+                               executor=executor)
+
+        __download_dataset("VOC2012", datasets_directory=args.datasets_directory,
+                           data_urls={
+                               'train': 'http://host.robots.ox.ac.uk/pascal/VOC/voc2012/VOCtrainval_11-May-2012.tar',
+                               'val': 'http://host.robots.ox.ac.uk/pascal/VOC/voc2012/VOCtrainval_11-May-2012.tar'},
+                           convert_truths=lambda dataset_directory, _:
+                           __convert_voc_truths(os.path.join(dataset_directory, "VOCdevkit", "VOC2012", "Annotations")),
+                           collect_image_files=lambda dataset_directory:
+                           __collect_images(os.path.join(dataset_directory, "VOCdevkit", "VOC2012", "JPEGImages"),
+                                            "jpg"),
+                           executor=executor)
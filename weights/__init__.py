@@ -1,5 +1,6 @@
 import os
 from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 
 import h5py
@@ -35,7 +36,7 @@ def expand_weights_names(*weights_names):
     """
     Expand file identifiers in the given weights_names
     """
-    return list(itertools.chain(*[[weights_name] if weights_name[0] is not _EXPANSION_FILE_IDENTIFIER
+    return list(itertools.chain(*[[weights_name] if weights_name[0] != _EXPANSION_FILE_IDENTIFIER
                                   else _resolve_weights_names_file(weights_name[1:])
                                   for weights_name in weights_names]))
 
@@ -43,26 +44,61 @@ def expand_weights_names(*weights_names):
 def load_weights(*weights_names, keep_names=False, weights_directory='weights'):
     weights_names = expand_weights_names(*weights_names)
 
-    weights = list()
-    for weights_name in weights_names:
-        filepath = "%s/%s%s" % (weights_directory, weights_name, '.h5' if not weights_name.endswith('.h5') else '')
-        with h5py.File(filepath, 'r') as file:
-            w = walk(file, lambda _, x: np.array(x))
-            if 'layer_names' in file.attrs:
-                # keras reordering
-                sorted_layers = [l.decode('utf8') for l in file.attrs['layer_names']]
-                w = sort_weights_by(w, sorted_layers)
-            weights.append(w)
+    filepaths = ["%s/%s%s" % (weights_directory, weights_name, '.h5' if not weights_name.endswith('.h5') else '')
+                 for weights_name in weights_names]
+    if len(filepaths) == 1:
+        weights = [_load_weights_file(filepaths[0])]
+    else:
+        # reading the files is I/O-bound and h5py releases the GIL around the HDF5 library
+        with ThreadPoolExecutor(max_workers=min(len(filepaths), 4)) as executor:
+            weights = list(executor.map(_load_weights_file, filepaths))
     if not keep_names:
         return weights if len(weights) > 1 else weights[0]
     else:
         return OrderedDict(zip(weights_names, weights))
 
 
-def walk(dictionary, collect, key_chain=None):
+def _read_dataset(dataset):
+    """
+    Read a dataset into a preallocated array - read_direct fills it in place,
+    avoiding the intermediate buffer (and thereby doubled peak memory)
+    of materializing the dataset first and copying it into an ndarray after.
+    """
+    if dataset.shape == ():  # read_direct does not support scalar datasets
+        return dataset[()]
+    values = np.empty(dataset.shape, dtype=dataset.dtype)
+    dataset.read_direct(values)
+    return values
+
+
+def _load_weights_file(filepath):
+    with h5py.File(filepath, 'r') as file:
+        w = OrderedDict()
+
+        def visit(name, item):
+            # visititems traverses the file once at the C level,
+            # without the per-level recursion of a python walk
+            nested = w
+            keys = name.split('/')
+            for key in keys[:-1]:
+                nested = nested.setdefault(key, OrderedDict())
+            if isinstance(item, h5py.Dataset):
+                nested[keys[-1]] = _read_dataset(item)
+            else:  # keep groups without datasets (e.g. pooling layers) as empty entries
+                nested.setdefault(keys[-1], OrderedDict())
+
+        file.visititems(visit)
+        if 'layer_names' in file.attrs:
+            # keras reordering
+            sorted_layers = [l.decode('utf8') for l in file.attrs['layer_names']]
+            w = sort_weights_by(w, sorted_layers)
+        return w
+
+
+def walk(dictionary, collect, key_chain=()):
     result = OrderedDict()
     for key, item in dictionary.items():
-        sub_key_chain = (key_chain if key_chain is not None else []) + [key]
+        sub_key_chain = tuple(key_chain) + (key,)
         if callable(getattr(item, "items", None)):
             result[key] = walk(item, collect, key_chain=sub_key_chain)
         else:
@@ -70,6 +106,23 @@ def walk(dictionary, collect, key_chain=None):
     return result
 
 
+def flatten_weights(weights, key_chain=()):
+    """
+    Flatten a nested weights dictionary into a flat OrderedDict keyed by the
+    tuples of nested keys, e.g. `{('conv_1', 'conv_1_W'): ...}`.
+    Looking up a leaf is then a single tuple hash
+    instead of one dictionary access per nesting level.
+    """
+    flat = OrderedDict()
+    for key, item in weights.items():
+        sub_key_chain = tuple(key_chain) + (key,)
+        if callable(getattr(item, "items", None)):
+            flat.update(flatten_weights(item, key_chain=sub_key_chain))
+        else:
+            flat[sub_key_chain] = item
+    return flat
+
+
 def walk_key_chain(dictionary, key_chain):
     """
     Walks down the nesting structure of a dictionary, following the keys in the `key_chain`.
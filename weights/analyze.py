@@ -1,10 +1,11 @@
 import numpy as np
 
-from weights import walk, walk_key_chain
+from weights import flatten_weights, walk
 
 
 def weight_differences(weights1, weights2):
-    return walk(weights1, collect=lambda key_chain, w1: w1 - walk_key_chain(weights2, key_chain))
+    flat2 = flatten_weights(weights2)
+    return walk(weights1, collect=lambda key_chain, w1: w1 - flat2[key_chain])
 
 
 def absolute(weights):
@@ -40,11 +41,13 @@ def count(weights):
 
 
 def divide(denominator, divider):
-    return walk(denominator, collect=lambda key_chain, x: x / walk_key_chain(divider, key_chain))
+    flat_divider = flatten_weights(divider)
+    return walk(denominator, collect=lambda key_chain, x: x / flat_divider[key_chain])
 
 
 def relativize(weights, base_weights):
-    return walk(weights, collect=lambda key_chain, x: x / walk_key_chain(base_weights, key_chain))
+    flat_base = flatten_weights(base_weights)
+    return walk(weights, collect=lambda key_chain, x: x / flat_base[key_chain])
 
 
 def proportion_different(weights1, weights2, mean_across_layers=False):
@@ -53,9 +56,10 @@ def proportion_different(weights1, weights2, mean_across_layers=False):
     divided by the total number of weights across all layers.
     """
     assert weights1.keys() == weights2.keys()
+    flat2 = flatten_weights(weights2)
 
     def collect_proportion_different(key_chain, w1):
-        w2 = walk_key_chain(weights2, key_chain)
+        w2 = flat2[key_chain]
         assert w2.size == w1.size
         return (w1 != w2).sum() / w1.size
 
@@ -74,10 +78,13 @@ def proportion_different(weights1, weights2, mean_across_layers=False):
 
 
 def z_score(weight_values, weight_means, weight_stds):
+    flat_means = flatten_weights(weight_means)
+    flat_stds = flatten_weights(weight_stds)
+
     def _z_score(key_chain, values):
-        mean = walk_key_chain(weight_means, key_chain)
+        mean = flat_means[key_chain]
         assert np.isscalar(mean)
-        std = walk_key_chain(weight_stds, key_chain)
+        std = flat_stds[key_chain]
         assert np.isscalar(std)
         return (values - mean) / std
 
@@ -86,14 +93,11 @@ def z_score(weight_values, weight_means, weight_stds):
 
 def summed_absolute_relative_diffs(weights, base_weights):
     weights_diffs = weight_differences(weights, base_weights)
-    relativized_diffs = walk(weights_diffs, collect=lambda key_chain, diffs:
-    diffs / walk_key_chain(base_weights, key_chain))
-    return sum(absolute(relativized_diffs))
+    return sum(absolute(relativize(weights_diffs, base_weights)))
 
 
 def relative_summed_absolute_diffs(weights, base_weights):
     weights_diffs = weight_differences(weights, base_weights)
     summed_absolute_diffs = sum(absolute(weights_diffs))
     summed_absolute_base = sum(absolute(base_weights))
-    return walk(summed_absolute_diffs, collect=lambda key_chain, diffs:
-    diffs / walk_key_chain(summed_absolute_base, key_chain))
+    return divide(summed_absolute_diffs, summed_absolute_base)